@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+かっぱキャラクター画像生成 HTTP API
+Web版と同じ生成処理をプログラムから呼び出すためのヘッドレスAPIサーバー
+"""
+
+import os
+import re
+import json
+import asyncio
+import threading
+from concurrent.futures import CancelledError
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from openai import OpenAI
+
+from image_generation import (
+    load_base_prompt,
+    load_patterns,
+    generate_image,
+    describe_generation_error,
+    save_image_to_file,
+)
+from request_control import DEFAULT_REQUEST_TIMEOUT, Deadline, LatencyTracker
+
+
+OUTPUT_DIR = Path("generated_images")
+
+# 同時に上流へ投げるリクエスト数の上限（ヘッジや破棄後も実行中の呼び出しを含む）
+MAX_CONCURRENCY = int(os.environ.get("KAPPA_API_MAX_CONCURRENCY", "4"))
+
+# 1リクエストあたりのデフォルトのタイムアウト（秒）
+REQUEST_TIMEOUT = float(os.environ.get("KAPPA_API_REQUEST_TIMEOUT", DEFAULT_REQUEST_TIMEOUT))
+
+# 画像IDの形式（save_image_to_fileが付けるファイル名の拡張子なし部分）
+IMAGE_ID_PATTERN = re.compile(r"^kappa_\d{8}_\d{6}(_p\d+)?(_\d+)?$")
+
+
+class GenerateRequest(BaseModel):
+    """1枚生成のリクエスト"""
+    pattern_number: Optional[int] = None
+    custom_prompt: Optional[str] = None
+    base_prompt: Optional[str] = None
+    base_images: Optional[List[str]] = None
+    timeout: Optional[float] = Field(None, gt=0)
+    hedge: bool = False
+
+
+class BatchGenerateRequest(BaseModel):
+    """一括生成のリクエスト（pattern_numbers省略時は全パターン、空のリストは不可）"""
+    pattern_numbers: Optional[List[int]] = Field(None, min_length=1)
+    base_prompt: Optional[str] = None
+    base_images: Optional[List[str]] = None
+    timeout: Optional[float] = Field(None, gt=0)
+    batch_timeout: Optional[float] = Field(None, gt=0)
+    hedge: bool = False
+
+
+@asynccontextmanager
+async def lifespan(api: FastAPI):
+    """OpenAIクライアントを1つだけ作り、全リクエストで接続プールを共有する"""
+    api_key = os.environ.get("OPENAI_API_KEY")
+    api.state.client = OpenAI(api_key=api_key) if api_key else None
+    api.state.semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    # 上流への呼び出しは終了するまで枠を占有する（キャンセル後の残りも数える）
+    api.state.upstream_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+    api.state.latency_tracker = LatencyTracker()
+    yield
+    if api.state.client is not None:
+        api.state.client.close()
+
+
+api = FastAPI(title="かっぱキャラクター画像生成 API", lifespan=lifespan)
+
+
+def build_prompt(base_prompt: Optional[str], pattern_prompt: str) -> str:
+    """ベースプロンプトとパターンを結合する（Web版と同じ形式）"""
+    if base_prompt is None:
+        base_prompt = load_base_prompt()
+    return f"{base_prompt}\n\n{pattern_prompt}"
+
+
+def get_pattern(patterns: list, pattern_number: int) -> str:
+    """パターン番号（1から始まる）からパターンを取得する"""
+    if pattern_number < 1 or pattern_number > len(patterns):
+        raise HTTPException(
+            status_code=400,
+            detail=f"パターン番号は 1 から {len(patterns)} の範囲で指定してください"
+        )
+    return patterns[pattern_number - 1]
+
+
+def get_client() -> OpenAI:
+    """共有のOpenAIクライアントを取得する"""
+    if api.state.client is None:
+        raise HTTPException(
+            status_code=503,
+            detail="エラー: OPENAI_API_KEY環境変数が設定されていません"
+        )
+    return api.state.client
+
+
+def image_url(image_id: str) -> str:
+    """画像IDから取得用URLを組み立てる"""
+    return f"/images/{image_id}"
+
+
+async def generate_and_save(
+    prompt: str,
+    base_images: Optional[List[str]],
+    pattern_number: Optional[int],
+    timeout: Optional[float] = None,
+    deadline: Optional[Deadline] = None,
+    hedge: bool = False,
+    cancel_event: Optional[threading.Event] = None
+) -> dict:
+    """
+    画像を生成して保存する（ブロッキング処理はスレッドで実行）
+
+    Returns:
+        dict: 成功時は id と url、失敗時は error と timeout（タイムアウトかどうか）を含む結果
+    """
+    client = get_client()
+
+    async with api.state.semaphore:
+        try:
+            image_base64 = await asyncio.to_thread(
+                generate_image,
+                prompt=prompt,
+                base_images=base_images or None,
+                client=client,
+                timeout=timeout or REQUEST_TIMEOUT,
+                deadline=deadline,
+                hedge=hedge,
+                tracker=api.state.latency_tracker,
+                cancel_event=cancel_event,
+                slots=api.state.upstream_slots
+            )
+        except asyncio.CancelledError:
+            # cancel_eventで中断したスレッド側のCancelledErrorは、asyncio.CancelledErrorとして届く
+            if cancel_event is None or not cancel_event.is_set():
+                raise
+            return {
+                "pattern_number": pattern_number,
+                "error": describe_generation_error(CancelledError()),
+                "timeout": False,
+            }
+        except Exception as e:
+            return {
+                "pattern_number": pattern_number,
+                "error": describe_generation_error(e),
+                "timeout": isinstance(e, TimeoutError),
+            }
+
+        saved_path = await asyncio.to_thread(
+            save_image_to_file,
+            image_base64=image_base64,
+            prompt=prompt,
+            pattern_number=pattern_number
+        )
+
+    image_id = saved_path.stem
+    return {
+        "pattern_number": pattern_number,
+        "id": image_id,
+        "url": image_url(image_id),
+    }
+
+
+async def cancel_on_disconnect(http_request: Request, cancel_event: threading.Event):
+    """
+    クライアントが切断したらcancel_eventをセットする
+
+    StreamingResponse以外のエンドポイントは切断されても中断されないため、
+    StreamingResponseと同じく受信メッセージを読んで切断を検知する。
+    """
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            cancel_event.set()
+            return
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Server-Sent Events形式の1イベントを組み立てる"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@api.get("/health")
+async def health():
+    """ヘルスチェック"""
+    return {"status": "ok"}
+
+
+@api.get("/patterns")
+async def list_patterns():
+    """利用可能なパターン一覧"""
+    patterns = load_patterns()
+    return {
+        "patterns": [
+            {"number": i, "prompt": pattern}
+            for i, pattern in enumerate(patterns, 1)
+        ]
+    }
+
+
+@api.post("/generate")
+async def generate(request: GenerateRequest, http_request: Request):
+    """パターン番号またはカスタムプロンプトで1枚生成する"""
+    if request.custom_prompt:
+        pattern_prompt = request.custom_prompt
+        pattern_number = None
+    else:
+        pattern_number = 1 if request.pattern_number is None else request.pattern_number
+        pattern_prompt = get_pattern(load_patterns(), pattern_number)
+
+    prompt = build_prompt(request.base_prompt, pattern_prompt)
+    cancel_event = threading.Event()
+    # クライアントが切断したらスレッド側の生成を打ち切る
+    disconnect_watcher = asyncio.create_task(cancel_on_disconnect(http_request, cancel_event))
+    try:
+        result = await generate_and_save(
+            prompt,
+            request.base_images,
+            pattern_number,
+            timeout=request.timeout,
+            hedge=request.hedge,
+            cancel_event=cancel_event
+        )
+    finally:
+        # サーバー停止などでこのリクエスト自体が中断された場合も生成を打ち切る
+        cancel_event.set()
+        disconnect_watcher.cancel()
+
+    if "error" in result:
+        # タイムアウトは504、上流のエラーは502で返す
+        status_code = 504 if result["timeout"] else 502
+        raise HTTPException(status_code=status_code, detail=result["error"])
+    return result
+
+
+@api.post("/generate/batch")
+async def generate_batch(request: BatchGenerateRequest):
+    """
+    複数パターンを並列に生成し、完了した順にSSEで進捗を返す
+
+    イベント:
+        progress: 1パターンの生成完了（成功時は id/url、失敗時は error）
+        done: 全体の結果サマリー
+    """
+    patterns = load_patterns()
+    if request.pattern_numbers is None:
+        pattern_numbers = list(range(1, len(patterns) + 1))
+    else:
+        pattern_numbers = request.pattern_numbers
+    jobs = [
+        (number, build_prompt(request.base_prompt, get_pattern(patterns, number)))
+        for number in pattern_numbers
+    ]
+    get_client()
+
+    async def event_stream():
+        deadline = Deadline(request.batch_timeout)
+        cancel_event = threading.Event()
+        tasks = [
+            asyncio.create_task(generate_and_save(
+                prompt,
+                request.base_images,
+                number,
+                timeout=request.timeout,
+                deadline=deadline,
+                hedge=request.hedge,
+                cancel_event=cancel_event
+            ))
+            for number, prompt in jobs
+        ]
+        total = len(tasks)
+        success_count = 0
+        failed_patterns = []
+
+        try:
+            for completed, task in enumerate(asyncio.as_completed(tasks), 1):
+                result = await task
+                if "error" in result:
+                    failed_patterns.append(result["pattern_number"])
+                else:
+                    success_count += 1
+                yield format_sse("progress", {"completed": completed, "total": total, **result})
+
+            yield format_sse("done", {
+                "success": success_count,
+                "total": total,
+                "failed_patterns": failed_patterns,
+            })
+        finally:
+            # クライアントが切断した場合は実行中の生成を打ち切り、残りのタスクを破棄する
+            cancel_event.set()
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@api.get("/images/{image_id}")
+async def get_image(image_id: str):
+    """保存済み画像をIDで取得する"""
+    if not IMAGE_ID_PATTERN.match(image_id):
+        raise HTTPException(status_code=400, detail="画像IDの形式が不正です")
+
+    image_filepath = OUTPUT_DIR / f"{image_id}.png"
+    if not image_filepath.is_file():
+        raise HTTPException(status_code=404, detail="画像が見つかりません")
+
+    return FileResponse(image_filepath, media_type="image/png")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        api,
+        host=os.environ.get("KAPPA_API_HOST", "0.0.0.0"),
+        port=int(os.environ.get("KAPPA_API_PORT", "8000"))
+    )
@@ -5,149 +5,100 @@ Responses API + 画像入力対応版
 """
 
 import os
-import base64
+import time
+import threading
 import streamlit as st
-from datetime import datetime
 from pathlib import Path
-from openai import OpenAI
 
+from request_control import DEFAULT_REQUEST_TIMEOUT, Deadline, LatencyTracker
+from image_io import encode_data_uri
+from image_generation import (
+    load_base_prompt,
+    load_patterns,
+    generate_image_with_deadline,
+    save_image_to_file,
+)
 
-def load_base_prompt(base_prompt_file: str = "prompts/base_prompt.txt") -> str:
-    """ベースプロンプトをファイルから読み込む"""
-    try:
-        with open(base_prompt_file, "r", encoding="utf-8") as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        return ""
 
+# セッションごとに上流へ同時に投げるリクエスト数の上限
+# キャンセル後もタイムアウトまで残る呼び出しを含めて数え、再生成の繰り返しで積み上がらないようにする
+SESSION_MAX_CONCURRENCY = 2
 
-def load_patterns(patterns_file: str = "prompts/patterns.txt") -> list:
-    """
-    パターンファイルから有効なパターンを読み込む
-    空白行で区切られた複数行のパターンに対応
-    """
-    try:
-        with open(patterns_file, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-
-        patterns = []
-        current_pattern = []
-
-        for line in lines:
-            line_stripped = line.strip()
-
-            # コメント行をスキップ
-            if line_stripped.startswith("#"):
-                continue
-
-            # 空行でパターン区切り
-            if not line_stripped:
-                if current_pattern:
-                    patterns.append("\n".join(current_pattern))
-                    current_pattern = []
-            else:
-                current_pattern.append(line_stripped)
-
-        # 最後のパターンを追加
-        if current_pattern:
-            patterns.append("\n".join(current_pattern))
-
-        return patterns
-    except FileNotFoundError:
-        return []
-
-
-def image_to_data_uri(image_bytes: bytes) -> str:
-    """画像バイトをdata URIに変換"""
-    b64 = base64.b64encode(image_bytes).decode()
-    return f"data:image/png;base64,{b64}"
 
-
-def generate_image_with_responses_api(
-    prompt: str,
-    base_images: list = None,
-    api_key: str = None
-) -> tuple:
+def images_to_data_uris(uploaded_files: list) -> list:
     """
-    Responses APIを使って画像生成（ベース画像対応）
-
-    Args:
-        prompt: プロンプトテキスト
-        base_images: ベース画像のdata URIリスト（任意）
-        api_key: OpenAI APIキー
+    アップロード画像をdata URIのリストに変換
 
-    Returns:
-        tuple: (image_bytes, error_message)
+    変換結果はセッション内でファイルごとにキャッシュし、
+    再実行や一括生成の各リクエストで同じ文字列を使い回す。
+    キャッシュは現在アップロードされているファイルの分だけを残す。
     """
-    if not api_key:
-        return None, "エラー: OPENAI_API_KEY環境変数が設定されていません"
-
-    try:
-        client = OpenAI(api_key=api_key)
-
-        # contentを構築
-        content = [{"type": "input_text", "text": prompt}]
-
-        # ベース画像があれば追加（最大5枚）
-        if base_images:
-            for img_uri in base_images[:5]:
-                content.append({
-                    "type": "input_image",
-                    "image_url": img_uri
-                })
-
-        # Responses APIで画像生成（gpt-4.1を使用）
-        response = client.responses.create(
-            model="gpt-4.1",
-            input=[
-                {
-                    "role": "user",
-                    "content": content
-                }
-            ],
-            tools=[{
-                "type": "image_generation",
-                "input_fidelity": "high" if base_images else "low"
-            }]
-        )
-
-        # 生成画像を取得
-        for output in response.output:
-            if output.type == "image_generation_call":
-                image_bytes = base64.b64decode(output.result)
-                return image_bytes, None
-
-        return None, "画像が生成されませんでした"
+    previous_cache = st.session_state.get("data_uri_cache", {})
+    cache = {}
+    for uploaded_file in uploaded_files:
+        data_uri = previous_cache.get(uploaded_file.file_id)
+        if data_uri is None:
+            data_uri = encode_data_uri(
+                uploaded_file.getbuffer(),
+                mime_type=uploaded_file.type or "image/png"
+            )
+        cache[uploaded_file.file_id] = data_uri
+    st.session_state.data_uri_cache = cache
+    return [cache[uploaded_file.file_id] for uploaded_file in uploaded_files]
 
-    except Exception as e:
-        return None, f"エラーが発生しました: {e}"
 
+def cancel_single_generation():
+    """
+    1枚生成をキャンセルする（キャンセルボタンのコールバック）
 
-def save_image_to_file(image_bytes: bytes, prompt: str, pattern_number: int = None):
-    """生成された画像をファイルに保存"""
-    output_dir = Path("generated_images")
-    output_dir.mkdir(exist_ok=True)
+    ボタンを押すとStreamlitが再実行され、実行中の生成は経過表示の更新時に中断される。
+    コールバックは再実行の最初に呼ばれるため、ここでは中断したことだけを記録する。
+    """
+    if st.session_state.get("single_running"):
+        st.session_state.single_running = False
+        st.session_state.single_cancelled = True
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    pattern_suffix = f"_p{pattern_number}" if pattern_number else ""
-    image_filename = f"kappa_{timestamp}{pattern_suffix}.png"
-    image_filepath = output_dir / image_filename
 
-    with open(image_filepath, "wb") as f:
-        f.write(image_bytes)
+def cancel_batch_generation():
+    """
+    一括生成をキャンセルする（キャンセルボタンのコールバック）
 
-    info_filename = f"kappa_{timestamp}{pattern_suffix}_info.txt"
-    info_filepath = output_dir / info_filename
+    中断までの結果はsession_stateに残っているため、再実行後に表示する。
+    """
+    batch_run = st.session_state.get("batch_run")
+    if batch_run is not None and batch_run["running"]:
+        batch_run["running"] = False
+        batch_run["stop_reason"] = "キャンセルされました"
+        st.session_state.show_stopped_batch = True
+
+
+def render_batch_result(pattern_number: int, pattern: str, saved_path: str):
+    """一括生成の1パターン分の結果を表示"""
+    col_img, col_info = st.columns([1, 2])
+    with col_img:
+        st.image(saved_path, caption=f"パターン#{pattern_number}", use_container_width=True)
+    with col_info:
+        st.markdown(f"**パターン #{pattern_number}**")
+        preview_text = pattern[:100] + "..." if len(pattern) > 100 else pattern
+        st.code(preview_text, language="text")
+        st.markdown(f"✅ 保存: `{Path(saved_path).name}`")
+
+
+def render_batch_summary(batch_run: dict):
+    """一括生成の結果サマリーを表示"""
+    success_count = len(batch_run["results"])
+    total = batch_run["total"]
 
-    with open(info_filepath, "w", encoding="utf-8") as f:
-        f.write(f"生成日時: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-        f.write(f"モデル: gpt-4.1 (Responses API with image_generation tool)\n")
-        f.write(f"画像ファイル: {image_filename}\n")
-        if pattern_number:
-            f.write(f"パターン番号: {pattern_number}\n")
-        f.write(f"\nプロンプト:\n{prompt}\n")
+    st.markdown("---")
+    if batch_run["stop_reason"]:
+        st.warning(f"⏹️ 一括生成を中断しました（{batch_run['stop_reason']}）。成功: {success_count}/{total}")
+    else:
+        st.success(f"✅ 一括生成完了! 成功: {success_count}/{total}")
 
-    return image_filepath
+    if batch_run["failed"]:
+        with st.expander("❌ 失敗したパターン"):
+            for num, desc in batch_run["failed"]:
+                st.markdown(f"- パターン#{num}: {desc}...")
 
 
 def main():
@@ -169,6 +120,35 @@ def main():
     st.sidebar.markdown("- プロンプトに画像サイズや画質を記述")
     st.sidebar.markdown("- パターンは空白行で区切る（複数行OK）")
     st.sidebar.markdown("- 例: `画像サイズ: 1024x1024, 画質: HD`")
+    st.sidebar.markdown("---")
+    st.sidebar.markdown("### ⏱️ 期限・ヘッジ")
+    request_timeout = st.sidebar.number_input(
+        "1枚あたりのタイムアウト（秒）",
+        min_value=10,
+        value=int(DEFAULT_REQUEST_TIMEOUT),
+        step=10
+    )
+    batch_timeout = st.sidebar.number_input(
+        "一括生成全体のタイムアウト（秒、0は無期限）",
+        min_value=0,
+        value=0,
+        step=60
+    )
+    hedge = st.sidebar.checkbox(
+        "ヘッジリクエスト",
+        value=False,
+        help="所要時間がp95を超えたら同じリクエストをもう1つ送り、先に完了した結果を使います"
+    )
+
+    # 所要時間の記録はセッション内で引き継ぐ（ヘッジ判定用）
+    if "latency_tracker" not in st.session_state:
+        st.session_state.latency_tracker = LatencyTracker()
+    latency_tracker = st.session_state.latency_tracker
+
+    # 上流への同時リクエスト数の枠もセッション内で引き継ぐ（キャンセル後に残った呼び出しも枠を占有する）
+    if "upstream_slots" not in st.session_state:
+        st.session_state.upstream_slots = threading.BoundedSemaphore(SESSION_MAX_CONCURRENCY)
+    upstream_slots = st.session_state.upstream_slots
 
     # APIキーの確認
     api_key = os.environ.get("OPENAI_API_KEY")
@@ -185,19 +165,19 @@ def main():
         help="ベース画像を使うと、その画像を参考に新しい画像を生成します"
     )
 
-    base_image_uris = []
-    if uploaded_files:
-        if len(uploaded_files) > 5:
-            st.warning("⚠️ ベース画像は最大5枚までです。最初の5枚を使用します。")
-            uploaded_files = uploaded_files[:5]
+    if uploaded_files and len(uploaded_files) > 5:
+        st.warning("⚠️ ベース画像は最大5枚までです。最初の5枚を使用します。")
+        uploaded_files = uploaded_files[:5]
 
+    # 削除されたファイルのキャッシュを破棄するため、アップロードがなくても毎回呼ぶ
+    base_image_uris = images_to_data_uris(uploaded_files or [])
+
+    if uploaded_files:
         st.markdown(f"**アップロード済み: {len(uploaded_files)}枚**")
         cols = st.columns(min(len(uploaded_files), 5))
         for i, file in enumerate(uploaded_files):
-            image_bytes = file.read()
-            base_image_uris.append(image_to_data_uri(image_bytes))
             with cols[i]:
-                st.image(image_bytes, caption=f"画像{i+1}", use_container_width=True)
+                st.image(file, caption=f"画像{i+1}", use_container_width=True)
 
     # ベースプロンプトの読み込みと表示
     base_prompt = load_base_prompt()
@@ -299,36 +279,52 @@ def main():
         # 最終プロンプトの構築
         final_prompt = f"{edited_base_prompt}\n\n{pattern_prompt}"
 
-        # 生成中の表示
+        st.button("⏹️ キャンセル", on_click=cancel_single_generation)
+        status_text = st.empty()
+        started_at = time.monotonic()
+        st.session_state.single_running = True
+
+        # 生成中の表示（経過表示の更新時にキャンセルボタンによる再実行で中断される）
         with st.spinner("画像を生成中... ⏳"):
-            image_bytes, error = generate_image_with_responses_api(
+            image_base64, error = generate_image_with_deadline(
                 prompt=final_prompt,
                 base_images=base_image_uris if base_image_uris else None,
-                api_key=api_key
+                api_key=api_key,
+                timeout=request_timeout,
+                hedge=hedge,
+                tracker=latency_tracker,
+                slots=upstream_slots,
+                on_wait=lambda: status_text.text(
+                    f"経過時間: {time.monotonic() - started_at:.0f}秒"
+                )
             )
+        st.session_state.single_running = False
+        status_text.empty()
 
         if error:
             st.error(error)
         else:
             st.success("✅ 画像生成成功!")
 
-            # 画像の表示
-            st.image(image_bytes, caption="生成されたかっぱのキャラクター", use_container_width=True)
-
             # ファイルに保存
             saved_path = save_image_to_file(
-                image_bytes=image_bytes,
+                image_base64=image_base64,
                 prompt=final_prompt,
                 pattern_number=pattern_number
             )
+            # 保存後はbase64文字列を保持しない
+            del image_base64
+
+            # 画像の表示（保存したファイルから読み込む）
+            st.image(str(saved_path), caption="生成されたかっぱのキャラクター", use_container_width=True)
 
             st.info(f"💾 画像を保存しました: {saved_path}")
 
-            # ダウンロードボタン
+            # ダウンロードボタン（クリック時に保存したファイルを読み込む）
             st.download_button(
                 label="📥 画像をダウンロード",
-                data=image_bytes,
-                file_name=f"kappa_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png",
+                data=saved_path.read_bytes,
+                file_name=saved_path.name,
                 mime="image/png"
             )
 
@@ -353,59 +349,89 @@ def main():
         st.markdown("---")
         st.header(f"🎨🎨 全パターン一括生成（{len(patterns)}枚）")
 
+        st.button("⏹️ 一括生成をキャンセル", on_click=cancel_batch_generation)
+
         progress_bar = st.progress(0)
         status_text = st.empty()
 
-        success_count = 0
-        failed_patterns = []
+        # 進捗はsession_stateに記録し、キャンセルによる再実行後も表示できるようにする
+        batch_run = {
+            "total": len(patterns),
+            "results": [],
+            "failed": [],
+            "stop_reason": None,
+            "running": True,
+        }
+        st.session_state.batch_run = batch_run
+        deadline = Deadline(batch_timeout or None)
 
         results_container = st.container()
 
         for i, pattern in enumerate(patterns):
+            if deadline.expired():
+                batch_run["stop_reason"] = f"一括生成のタイムアウト（{batch_timeout}秒）に達しました"
+                for j, rest in enumerate(patterns[i:], i + 1):
+                    batch_run["failed"].append((j, rest.split('\n')[0][:30]))
+                break
+
             progress = (i + 1) / len(patterns)
             progress_bar.progress(progress)
-            status_text.text(f"生成中... [{i+1}/{len(patterns)}] パターン#{i+1}")
+            status_message = f"生成中... [{i+1}/{len(patterns)}] パターン#{i+1}"
+            status_text.text(status_message)
+            started_at = time.monotonic()
 
             final_prompt = f"{edited_base_prompt}\n\n{pattern}"
 
-            image_bytes, error = generate_image_with_responses_api(
+            # 経過表示の更新時にキャンセルボタンによる再実行で中断される
+            image_base64, error = generate_image_with_deadline(
                 prompt=final_prompt,
                 base_images=base_image_uris if base_image_uris else None,
-                api_key=api_key
+                api_key=api_key,
+                timeout=request_timeout,
+                deadline=deadline,
+                hedge=hedge,
+                tracker=latency_tracker,
+                slots=upstream_slots,
+                on_wait=lambda: status_text.text(
+                    f"{status_message}（{time.monotonic() - started_at:.0f}秒経過）"
+                )
             )
 
             if error:
                 first_line = pattern.split('\n')[0]
-                failed_patterns.append((i+1, first_line[:30]))
+                batch_run["failed"].append((i+1, first_line[:30]))
             else:
-                success_count += 1
                 saved_path = save_image_to_file(
-                    image_bytes=image_bytes,
+                    image_base64=image_base64,
                     prompt=final_prompt,
                     pattern_number=i+1
                 )
+                # 次のパターンの生成中まで保持しないよう解放する
+                del image_base64
 
+                batch_run["results"].append((i+1, pattern, str(saved_path)))
                 with results_container:
-                    col_img, col_info = st.columns([1, 2])
-                    with col_img:
-                        st.image(image_bytes, caption=f"パターン#{i+1}", use_container_width=True)
-                    with col_info:
-                        st.markdown(f"**パターン #{i+1}**")
-                        preview_text = pattern[:100] + "..." if len(pattern) > 100 else pattern
-                        st.code(preview_text, language="text")
-                        st.markdown(f"✅ 保存: `{saved_path.name}`")
+                    render_batch_result(i+1, pattern, str(saved_path))
+
+        batch_run["running"] = False
 
         # 結果サマリー
         progress_bar.progress(1.0)
         status_text.text("完了!")
 
+        render_batch_summary(batch_run)
+
+    # キャンセルで中断した一括生成の結果を再実行後に表示
+    if st.session_state.pop("show_stopped_batch", False):
+        batch_run = st.session_state.batch_run
         st.markdown("---")
-        st.success(f"✅ 一括生成完了! 成功: {success_count}/{len(patterns)}")
+        st.header(f"🎨🎨 全パターン一括生成（{batch_run['total']}枚）")
+        for pattern_number, pattern, saved_path in batch_run["results"]:
+            render_batch_result(pattern_number, pattern, saved_path)
+        render_batch_summary(batch_run)
 
-        if failed_patterns:
-            with st.expander("❌ 失敗したパターン"):
-                for num, desc in failed_patterns:
-                    st.markdown(f"- パターン#{num}: {desc}...")
+    if st.session_state.pop("single_cancelled", False):
+        st.warning("⏹️ 画像生成をキャンセルしました")
 
     # フッター
     st.markdown("---")
@@ -6,11 +6,24 @@ OpenAI GPT Image 1.5を使用
 
 import os
 import sys
-import base64
 import argparse
 from datetime import datetime
 from pathlib import Path
-from openai import OpenAI
+from openai import OpenAI, APITimeoutError, NOT_GIVEN
+
+from request_control import (
+    DEFAULT_REQUEST_TIMEOUT,
+    Deadline,
+    LatencyTracker,
+    call_with_deadline,
+)
+from tracing import NULL_TRACER, Tracer
+from image_io import write_base64_to_file
+from image_generation import RETRYABLE_ERRORS
+
+
+# 一括生成中の所要時間（ヘッジ判定用）
+latency_tracker = LatencyTracker()
 
 
 def load_base_prompt(base_prompt_file: str = "prompts/base_prompt.txt") -> str:
@@ -91,11 +104,52 @@ def list_patterns(patterns: list):
     print("=" * 60)
 
 
+def request_image(
+    client: OpenAI,
+    prompt: str,
+    size: str,
+    quality: str,
+    timeout: float = None
+) -> str:
+    """
+    GPT Image 1.5に画像生成をリクエストする
+
+    Args:
+        client: OpenAIクライアント
+        prompt: プロンプト
+        size: 画像サイズ
+        quality: 画質
+        timeout: タイムアウト（秒、Noneの場合はSDKのデフォルト）
+
+    Returns:
+        生成された画像データ（base64形式）
+    """
+    # SDKの自動リトライはタイムアウトを超えて呼び出しを延ばすため無効にし、
+    # 再試行はcall_with_deadlineが残り時間内で行う
+    try:
+        response = client.with_options(max_retries=0).images.generate(
+            model="gpt-image-1.5",
+            prompt=prompt,
+            size=size,
+            quality=quality,
+            n=1,
+            timeout=timeout if timeout is not None else NOT_GIVEN,
+        )
+    except APITimeoutError as e:
+        raise TimeoutError("APIからの応答がタイムアウトしました") from e
+
+    return response.data[0].b64_json
+
+
 def generate_kappa_image(
     prompt: str,
     size: str = "1024x1024",
     quality: str = "standard",
-    pattern_number: int = None
+    pattern_number: int = None,
+    timeout: float = DEFAULT_REQUEST_TIMEOUT,
+    deadline: Deadline = None,
+    hedge: bool = False,
+    tracer: Tracer = NULL_TRACER
 ):
     """
     かっぱのキャラクター画像を生成する
@@ -105,33 +159,44 @@ def generate_kappa_image(
         size: 画像サイズ ("1024x1024", "1024x1792", "1792x1024")
         quality: 画質 ("standard" or "hd")
         pattern_number: 使用したパターン番号（記録用、Noneの場合は記録しない）
+        timeout: 1リクエストのタイムアウト（秒、Noneの場合はSDKのデフォルト）
+        deadline: 一括生成全体の締め切り（任意）
+        hedge: p95を超えたら重複リクエストを送るか
+        tracer: フェーズごとの所要時間の記録先
+
+    Raises:
+        TimeoutError: タイムアウトまたは締め切り超過の場合
     """
-    # OpenAI APIキーの確認
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
-        print("エラー: OPENAI_API_KEY環境変数が設定されていません")
-        sys.exit(1)
+    with tracer.span("client", pattern=pattern_number):
+        # OpenAI APIキーの確認
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if not api_key:
+            print("エラー: OPENAI_API_KEY環境変数が設定されていません")
+            sys.exit(1)
 
-    # OpenAIクライアントの初期化
-    client = OpenAI(api_key=api_key)
+        # OpenAIクライアントの初期化
+        client = OpenAI(api_key=api_key)
 
     print(f"\n画像生成中...")
     print(f"プロンプト: {prompt[:100]}..." if len(prompt) > 100 else f"プロンプト: {prompt}")
     print(f"サイズ: {size}, 画質: {quality}")
 
-    try:
-        # GPT Image 1.5で画像生成
-        response = client.images.generate(
-            model="gpt-image-1.5",
-            prompt=prompt,
-            size=size,
-            quality=quality,
-            n=1,
-        )
+    def traced_request(remaining):
+        # ヘッジ時は複数スレッドで重なって記録される
+        with tracer.span("network", pattern=pattern_number):
+            return request_image(client, prompt, size, quality, remaining)
 
-        # 生成された画像データ（base64形式）
-        image_base64 = response.data[0].b64_json
-        image_bytes = base64.b64decode(image_base64)
+    try:
+        # GPT Image 1.5で画像生成（期限・ヘッジ付き）
+        with tracer.span("request", pattern=pattern_number):
+            image_base64 = call_with_deadline(
+                traced_request,
+                timeout=timeout,
+                deadline=deadline,
+                tracker=latency_tracker,
+                hedge=hedge,
+                retry_on=RETRYABLE_ERRORS
+            )
 
         print(f"\n✓ 画像生成成功!")
 
@@ -145,9 +210,9 @@ def generate_kappa_image(
         image_filename = f"kappa_{timestamp}{pattern_suffix}.png"
         image_filepath = output_dir / image_filename
 
-        # 画像を保存
+        # 画像を保存（base64をチャンクごとにデコードしながら書き込み、decodeとwrite_imageを別々に記録）
         with open(image_filepath, "wb") as f:
-            f.write(image_bytes)
+            write_base64_to_file(image_base64, f, tracer, pattern=pattern_number)
 
         print(f"画像を保存しました: {image_filepath}")
 
@@ -155,25 +220,36 @@ def generate_kappa_image(
         info_filename = f"kappa_{timestamp}{pattern_suffix}_info.txt"
         info_filepath = output_dir / info_filename
 
-        with open(info_filepath, "w", encoding="utf-8") as f:
-            f.write(f"生成日時: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"モデル: gpt-image-1.5\n")
-            f.write(f"画像ファイル: {image_filename}\n")
-            f.write(f"サイズ: {size}\n")
-            f.write(f"画質: {quality}\n")
-            if pattern_number:
-                f.write(f"パターン番号: {pattern_number}\n")
-            f.write(f"\nプロンプト:\n{prompt}\n")
+        with tracer.span("write_info", pattern=pattern_number):
+            with open(info_filepath, "w", encoding="utf-8") as f:
+                f.write(f"生成日時: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+                f.write(f"モデル: gpt-image-1.5\n")
+                f.write(f"画像ファイル: {image_filename}\n")
+                f.write(f"サイズ: {size}\n")
+                f.write(f"画質: {quality}\n")
+                if pattern_number:
+                    f.write(f"パターン番号: {pattern_number}\n")
+                f.write(f"\nプロンプト:\n{prompt}\n")
 
         print(f"画像情報を保存しました: {info_filepath}")
 
         return image_filepath, prompt
 
+    except TimeoutError:
+        raise
     except Exception as e:
         print(f"エラーが発生しました: {e}")
         sys.exit(1)
 
 
+def positive_float(value: str) -> float:
+    """0より大きい秒数を受け付けるargparse用の型"""
+    seconds = float(value)
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError(f"0より大きい値を指定してください: {value}")
+    return seconds
+
+
 def main():
     """メイン関数"""
     parser = argparse.ArgumentParser(
@@ -198,6 +274,12 @@ def main():
 
   # カスタムサイズで生成
   python generate_kappa.py --pattern 1 --size 1024x1792
+
+  # 1枚60秒・全体30分の期限付きで、遅いリクエストをヘッジしながら一括生成
+  python generate_kappa.py --all --timeout 60 --batch-timeout 1800 --hedge
+
+  # フェーズごとの所要時間をトレース出力し、集計を表示
+  python generate_kappa.py --all --trace trace.json --profile
         """
     )
 
@@ -235,18 +317,64 @@ def main():
         choices=["standard", "hd"],
         help="画質（デフォルト: standard）"
     )
+    parser.add_argument(
+        "--timeout", "-t",
+        type=positive_float,
+        default=DEFAULT_REQUEST_TIMEOUT,
+        help=f"1リクエストのタイムアウト秒数（デフォルト: {DEFAULT_REQUEST_TIMEOUT:g}）"
+    )
+    parser.add_argument(
+        "--batch-timeout",
+        type=positive_float,
+        default=None,
+        help="一括生成全体のタイムアウト秒数（デフォルト: なし）"
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="所要時間がp95を超えたリクエストを重複送信し、先に完了した結果を使う"
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        metavar="FILE",
+        help="フェーズごとの所要時間をChrome trace-event形式のJSONで保存"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="一括生成の最後にフェーズ別の所要時間を表形式で表示"
+    )
 
     args = parser.parse_args()
 
+    tracer = Tracer() if (args.trace or args.profile) else NULL_TRACER
+    try:
+        run(args, tracer)
+    finally:
+        if args.trace:
+            tracer.save(args.trace)
+            print(f"トレースを保存しました: {args.trace}")
+
+
+def run(args: argparse.Namespace, tracer: Tracer):
+    """
+    コマンドライン引数に従って画像を生成する
+
+    Args:
+        args: コマンドライン引数
+        tracer: フェーズごとの所要時間の記録先
+    """
     print("=" * 60)
     print("かっぱキャラクター画像生成スクリプト (GPT Image 1.5)")
     print("=" * 60)
 
-    # ベースプロンプトを読み込む
-    base_prompt = load_base_prompt()
+    with tracer.span("load_prompts"):
+        # ベースプロンプトを読み込む
+        base_prompt = load_base_prompt()
 
-    # パターンを読み込む
-    patterns = load_patterns()
+        # パターンを読み込む
+        patterns = load_patterns()
 
     # パターン一覧表示
     if args.list:
@@ -261,18 +389,31 @@ def main():
 
         success_count = 0
         failed_patterns = []
+        deadline = Deadline(args.batch_timeout)
 
         for i, pattern in enumerate(patterns, 1):
+            if deadline.expired():
+                print(f"\n⚠️  一括生成のタイムアウト（{args.batch_timeout:g}秒）に達したため中断します")
+                failed_patterns.extend((j, p[:30]) for j, p in enumerate(patterns[i - 1:], i))
+                break
+
             print(f"\n[{i}/{len(patterns)}] パターン#{i}: {pattern[:60]}...")
-            prompt = f"{base_prompt}\n{pattern}"
 
             try:
-                generate_kappa_image(
-                    prompt=prompt,
-                    size=args.size,
-                    quality=args.quality,
-                    pattern_number=i
-                )
+                with tracer.span("pattern", pattern=i):
+                    with tracer.span("prompt", pattern=i):
+                        prompt = f"{base_prompt}\n{pattern}"
+
+                    generate_kappa_image(
+                        prompt=prompt,
+                        size=args.size,
+                        quality=args.quality,
+                        pattern_number=i,
+                        timeout=args.timeout,
+                        deadline=deadline,
+                        hedge=args.hedge,
+                        tracer=tracer
+                    )
                 success_count += 1
             except Exception as e:
                 print(f"⚠️  パターン#{i}の生成に失敗しました: {e}")
@@ -288,39 +429,49 @@ def main():
             for num, desc in failed_patterns:
                 print(f"  - パターン#{num}: {desc}...")
         print("=" * 60)
+
+        if args.profile:
+            tracer.print_summary()
         return
 
     # プロンプトを構築
-    pattern_number = None
-    if args.pattern:
-        # パターン番号チェック
-        if args.pattern < 1 or args.pattern > len(patterns):
-            print(f"エラー: パターン番号は 1 から {len(patterns)} の範囲で指定してください")
-            sys.exit(1)
-
-        selected_pattern = patterns[args.pattern - 1]
-        prompt = f"{base_prompt}\n{selected_pattern}"
-        pattern_number = args.pattern
-        print(f"\n使用パターン: #{args.pattern}")
-        print(f"  {selected_pattern}")
-    elif args.custom:
-        # カスタムプロンプト
-        prompt = f"{base_prompt}\n{args.custom}"
-        print(f"\nカスタムプロンプト: {args.custom}")
-    else:
-        # デフォルト（パターン1を使用）
-        prompt = f"{base_prompt}\n{patterns[0]}"
-        pattern_number = 1
-        print(f"\nデフォルトパターン（#1）を使用")
-        print(f"  {patterns[0]}")
+    with tracer.span("prompt"):
+        pattern_number = None
+        if args.pattern:
+            # パターン番号チェック
+            if args.pattern < 1 or args.pattern > len(patterns):
+                print(f"エラー: パターン番号は 1 から {len(patterns)} の範囲で指定してください")
+                sys.exit(1)
+
+            selected_pattern = patterns[args.pattern - 1]
+            prompt = f"{base_prompt}\n{selected_pattern}"
+            pattern_number = args.pattern
+            print(f"\n使用パターン: #{args.pattern}")
+            print(f"  {selected_pattern}")
+        elif args.custom:
+            # カスタムプロンプト
+            prompt = f"{base_prompt}\n{args.custom}"
+            print(f"\nカスタムプロンプト: {args.custom}")
+        else:
+            # デフォルト（パターン1を使用）
+            prompt = f"{base_prompt}\n{patterns[0]}"
+            pattern_number = 1
+            print(f"\nデフォルトパターン（#1）を使用")
+            print(f"  {patterns[0]}")
 
     # 画像生成
-    generate_kappa_image(
-        prompt=prompt,
-        size=args.size,
-        quality=args.quality,
-        pattern_number=pattern_number
-    )
+    try:
+        generate_kappa_image(
+            prompt=prompt,
+            size=args.size,
+            quality=args.quality,
+            pattern_number=pattern_number,
+            timeout=args.timeout,
+            tracer=tracer
+        )
+    except TimeoutError as e:
+        print(f"エラー: タイムアウトしました: {e}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
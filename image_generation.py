@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+かっぱキャラクター画像生成の共通処理
+Web版（Streamlit）とHTTP API版で共通して使用
+"""
+
+import threading
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import CancelledError
+from openai import (
+    OpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+    NOT_GIVEN,
+)
+
+from request_control import (
+    DEFAULT_REQUEST_TIMEOUT,
+    Deadline,
+    LatencyTracker,
+    call_with_deadline,
+)
+from image_io import write_base64_to_file
+
+
+# 残り時間内で再試行するエラー（SDKの自動リトライが対象とする一時的な失敗）
+# タイムアウトはrequest_image_generationでTimeoutErrorに変換するため再試行しない
+RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+
+def load_base_prompt(base_prompt_file: str = "prompts/base_prompt.txt") -> str:
+    """ベースプロンプトをファイルから読み込む"""
+    try:
+        with open(base_prompt_file, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def load_patterns(patterns_file: str = "prompts/patterns.txt") -> list:
+    """
+    パターンファイルから有効なパターンを読み込む
+    空白行で区切られた複数行のパターンに対応
+    """
+    try:
+        with open(patterns_file, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+
+        patterns = []
+        current_pattern = []
+
+        for line in lines:
+            line_stripped = line.strip()
+
+            # コメント行をスキップ
+            if line_stripped.startswith("#"):
+                continue
+
+            # 空行でパターン区切り
+            if not line_stripped:
+                if current_pattern:
+                    patterns.append("\n".join(current_pattern))
+                    current_pattern = []
+            else:
+                current_pattern.append(line_stripped)
+
+        # 最後のパターンを追加
+        if current_pattern:
+            patterns.append("\n".join(current_pattern))
+
+        return patterns
+    except FileNotFoundError:
+        return []
+
+
+class ImageGenerationError(Exception):
+    """画像生成APIが画像を返さなかった場合のエラー"""
+
+
+def request_image_generation(
+    client: OpenAI,
+    prompt: str,
+    base_images: list = None,
+    timeout: float = None
+) -> str:
+    """
+    Responses APIに画像生成をリクエストする（失敗時は例外を送出）
+
+    Args:
+        client: OpenAIクライアント
+        prompt: プロンプトテキスト
+        base_images: ベース画像のdata URIリスト（任意）
+        timeout: タイムアウト（秒、Noneの場合はSDKのデフォルト）
+
+    Returns:
+        生成された画像データ（base64形式）
+
+    Raises:
+        ImageGenerationError: 画像が生成されなかった場合
+        TimeoutError: APIからの応答がタイムアウトした場合
+    """
+    # contentを構築
+    content = [{"type": "input_text", "text": prompt}]
+
+    # ベース画像があれば追加（最大5枚）
+    if base_images:
+        for img_uri in base_images[:5]:
+            content.append({
+                "type": "input_image",
+                "image_url": img_uri
+            })
+
+    # Responses APIで画像生成（gpt-4.1を使用）
+    # SDKの自動リトライはタイムアウトを超えて呼び出しを延ばすため無効にし、
+    # 再試行はcall_with_deadlineが残り時間内で行う
+    try:
+        response = client.with_options(max_retries=0).responses.create(
+            model="gpt-4.1",
+            input=[
+                {
+                    "role": "user",
+                    "content": content
+                }
+            ],
+            tools=[{
+                "type": "image_generation",
+                "input_fidelity": "high" if base_images else "low"
+            }],
+            timeout=timeout if timeout is not None else NOT_GIVEN
+        )
+    except APITimeoutError as e:
+        raise TimeoutError("APIからの応答がタイムアウトしました") from e
+
+    # 生成画像を取得（デコードは保存時にファイルへ直接行う）
+    for output in response.output:
+        if output.type == "image_generation_call":
+            return output.result
+
+    raise ImageGenerationError("画像が生成されませんでした")
+
+
+def generate_image_with_responses_api(
+    prompt: str,
+    base_images: list = None,
+    api_key: str = None,
+    client: OpenAI = None,
+    timeout: float = None
+) -> tuple:
+    """
+    Responses APIを使って画像生成（ベース画像対応）
+
+    Args:
+        prompt: プロンプトテキスト
+        base_images: ベース画像のdata URIリスト（任意）
+        api_key: OpenAI APIキー
+        client: 使い回すOpenAIクライアント（任意、指定時は接続プールを共有）
+        timeout: タイムアウト（秒、Noneの場合はSDKのデフォルト）
+
+    Returns:
+        tuple: (image_base64, error_message)
+    """
+    if client is None and not api_key:
+        return None, "エラー: OPENAI_API_KEY環境変数が設定されていません"
+
+    try:
+        if client is None:
+            client = OpenAI(api_key=api_key)
+        return request_image_generation(client, prompt, base_images, timeout), None
+    except ImageGenerationError as e:
+        return None, str(e)
+    except Exception as e:
+        return None, f"エラーが発生しました: {e}"
+
+
+def generate_image(
+    prompt: str,
+    base_images: list = None,
+    api_key: str = None,
+    client: OpenAI = None,
+    timeout: float = DEFAULT_REQUEST_TIMEOUT,
+    deadline: Deadline = None,
+    hedge: bool = False,
+    tracker: LatencyTracker = None,
+    cancel_event: threading.Event = None,
+    slots: threading.Semaphore = None,
+    on_wait=None
+) -> str:
+    """
+    期限・キャンセル・ヘッジ付きで画像生成（失敗時は例外を送出）
+
+    失敗した呼び出しは例外のまま扱うため、所要時間の記録やヘッジの勝者にはならない。
+    レート制限や一時的なサーバーエラーは残り時間内で再試行する。
+
+    Args:
+        prompt: プロンプトテキスト
+        base_images: ベース画像のdata URIリスト（任意）
+        api_key: OpenAI APIキー
+        client: 使い回すOpenAIクライアント（任意）
+        timeout: 1リクエストのタイムアウト（秒、Noneの場合はSDKのデフォルト）
+        deadline: 一括生成全体の締め切り（任意）
+        hedge: p95を超えたら重複リクエストを送るか
+        tracker: 所要時間の記録先（ヘッジ判定に使用）
+        cancel_event: セットされたら生成を中断するイベント
+        slots: 上流への同時リクエスト数を制限するセマフォ（任意）
+        on_wait: 待機中に定期的に呼ぶ関数（任意、画面の経過表示の更新など）
+
+    Returns:
+        生成された画像データ（base64形式）
+
+    Raises:
+        TimeoutError: タイムアウトまたは締め切り超過の場合
+        CancelledError: キャンセルされた場合
+        ImageGenerationError: APIキー未設定、または画像が生成されなかった場合
+    """
+    if client is None:
+        if not api_key:
+            raise ImageGenerationError("エラー: OPENAI_API_KEY環境変数が設定されていません")
+        client = OpenAI(api_key=api_key)
+
+    return call_with_deadline(
+        lambda remaining: request_image_generation(
+            client,
+            prompt,
+            base_images=base_images,
+            timeout=remaining
+        ),
+        timeout=timeout,
+        deadline=deadline,
+        cancel_event=cancel_event,
+        tracker=tracker,
+        hedge=hedge,
+        slots=slots,
+        on_wait=on_wait,
+        retry_on=RETRYABLE_ERRORS
+    )
+
+
+def describe_generation_error(error: Exception) -> str:
+    """画像生成の例外を表示用のエラーメッセージに変換"""
+    if isinstance(error, TimeoutError):
+        return f"タイムアウトしました: {error}"
+    if isinstance(error, CancelledError):
+        return "キャンセルされました"
+    if isinstance(error, ImageGenerationError):
+        return str(error)
+    return f"エラーが発生しました: {error}"
+
+
+def generate_image_with_deadline(prompt: str, **kwargs) -> tuple:
+    """
+    期限・キャンセル・ヘッジ付きで画像生成
+
+    Args:
+        prompt: プロンプトテキスト
+        **kwargs: generate_imageと同じ引数
+
+    Returns:
+        tuple: (image_base64, error_message)
+    """
+    try:
+        return generate_image(prompt, **kwargs), None
+    except Exception as e:
+        return None, describe_generation_error(e)
+
+
+def save_image_to_file(image_base64: str, prompt: str, pattern_number: int = None):
+    """生成された画像（base64形式）をデコードしながらファイルに保存"""
+    output_dir = Path("generated_images")
+    output_dir.mkdir(exist_ok=True)
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    pattern_suffix = f"_p{pattern_number}" if pattern_number else ""
+
+    # 同一秒に複数保存された場合（APIからの並列生成など）は連番を付けて上書きを防ぐ
+    duplicate_index = 1
+    while True:
+        duplicate_suffix = f"_{duplicate_index}" if duplicate_index > 1 else ""
+        file_stem = f"kappa_{timestamp}{pattern_suffix}{duplicate_suffix}"
+        image_filename = f"{file_stem}.png"
+        image_filepath = output_dir / image_filename
+        try:
+            with open(image_filepath, "xb") as f:
+                write_base64_to_file(image_base64, f)
+            break
+        except FileExistsError:
+            duplicate_index += 1
+
+    info_filename = f"{file_stem}_info.txt"
+    info_filepath = output_dir / info_filename
+
+    with open(info_filepath, "w", encoding="utf-8") as f:
+        f.write(f"生成日時: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.write(f"モデル: gpt-4.1 (Responses API with image_generation tool)\n")
+        f.write(f"画像ファイル: {image_filename}\n")
+        if pattern_number:
+            f.write(f"パターン番号: {pattern_number}\n")
+        f.write(f"\nプロンプト:\n{prompt}\n")
+
+    return image_filepath
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+画像データのbase64エンコード・デコード
+デコードはチャンク単位で行い、画像全体のコピーをメモリ上に作らない
+"""
+
+import base64
+from typing import BinaryIO
+
+from tracing import NULL_TRACER, Tracer
+
+
+# 1回に処理するbase64文字数（4の倍数にすること）
+BASE64_CHUNK_CHARS = 1 << 20
+
+
+def encode_data_uri(image_data, mime_type: str = "image/png") -> str:
+    """
+    画像データをdata URIに変換する
+
+    Args:
+        image_data: 画像データ（bytes、memoryviewなど。コピーせずにそのまま読む）
+        mime_type: 画像のMIMEタイプ
+
+    Returns:
+        data URI文字列
+    """
+    encoded = base64.b64encode(image_data).decode("ascii")
+    return f"data:{mime_type};base64,{encoded}"
+
+
+def write_base64_to_file(
+    image_base64: str,
+    f: BinaryIO,
+    tracer: Tracer = NULL_TRACER,
+    **span_args
+) -> int:
+    """
+    base64文字列をチャンクごとにデコードしてファイルへ書き込む
+
+    デコード済みの画像全体をメモリ上に保持しない。
+    デコードと書き込みはチャンクごとに別のフェーズ（decode, write_image）として記録する。
+
+    Args:
+        image_base64: base64形式の画像データ
+        f: バイナリモードで開いた書き込み先
+        tracer: フェーズごとの所要時間の記録先
+        **span_args: トレースに付加する情報（パターン番号など）
+
+    Returns:
+        書き込んだバイト数
+    """
+    written = 0
+    for start in range(0, len(image_base64), BASE64_CHUNK_CHARS):
+        with tracer.span("decode", **span_args):
+            chunk = base64.b64decode(image_base64[start:start + BASE64_CHUNK_CHARS])
+        with tracer.span("write_image", **span_args):
+            f.write(chunk)
+        written += len(chunk)
+    return written
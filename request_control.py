@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+画像生成リクエストの期限・キャンセル・ヘッジ制御
+CLI版・Web版・HTTP API版で共通して使用
+"""
+
+import time
+import threading
+from concurrent.futures import (
+    Future,
+    CancelledError,
+    FIRST_COMPLETED,
+    wait,
+)
+
+
+# 1リクエストあたりのデフォルトのタイムアウト（秒）
+DEFAULT_REQUEST_TIMEOUT = 180.0
+
+# 再試行できるエラーの最大再試行回数と、初回の待ち時間（秒、以降は倍にする）
+DEFAULT_MAX_RETRIES = 2
+RETRY_BACKOFF = 0.5
+
+
+class Deadline:
+    """
+    一括生成全体などの締め切り時刻を表す
+
+    Args:
+        seconds: 現在からの制限時間（秒）。Noneの場合は無期限
+    """
+
+    def __init__(self, seconds: float = None):
+        self.expires_at = time.monotonic() + seconds if seconds is not None else None
+
+    def remaining(self) -> float:
+        """残り時間（秒）。無期限の場合はNone"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        """締め切りを過ぎているか"""
+        return self.expires_at is not None and self.remaining() <= 0
+
+    def clamp(self, timeout: float = None) -> float:
+        """1リクエストのタイムアウトを残り時間以内に切り詰める"""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+
+class LatencyTracker:
+    """
+    直近のリクエスト所要時間を記録し、ヘッジ判定用のp95を返す（スレッドセーフ）
+
+    Args:
+        min_samples: p95を返すのに必要な最小サンプル数
+        max_samples: 保持する直近サンプル数
+    """
+
+    def __init__(self, min_samples: int = 5, max_samples: int = 200):
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        """所要時間を記録する"""
+        with self._lock:
+            self._samples.append(seconds)
+            if len(self._samples) > self.max_samples:
+                del self._samples[0]
+
+    def p95(self) -> float:
+        """p95の所要時間（秒）。サンプル不足の場合はNone"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(len(samples) * 0.95))
+        return samples[index]
+
+
+def call_with_deadline(
+    fn,
+    timeout: float = None,
+    deadline: Deadline = None,
+    cancel_event: threading.Event = None,
+    tracker: LatencyTracker = None,
+    hedge: bool = False,
+    slots: threading.Semaphore = None,
+    on_wait=None,
+    retry_on: tuple = (),
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    poll_interval: float = 0.2
+):
+    """
+    期限・キャンセル・ヘッジ付きで関数を呼び出す
+
+    fnは残り時間（秒、Noneは上限なし）を引数に取り、その時間内に上流呼び出しを
+    打ち切るようにする（Noneの場合もSDKのデフォルトのタイムアウトは残すこと）。
+    hedge=Trueの場合、呼び出しが観測済みのp95を超えたら同じリクエストを
+    もう1つ送り、先に完了した方の結果を採用する。
+
+    中断・タイムアウト・ヘッジ負けで破棄した呼び出しは、fnに渡したタイムアウトで
+    終了するまでスレッド上で動き続ける。slotsを指定すると、そうした呼び出しも
+    終了するまで上流への同時リクエスト数に数える。
+
+    retry_onに指定した例外は、残り時間内に収まる場合に限り間隔を空けて再試行する
+    （タイムアウトを超えないよう、SDKの自動リトライは無効にしてこちらで行う）。
+
+    Args:
+        fn: 残り時間を受け取って結果を返す関数
+        timeout: 1リクエストのタイムアウト（秒、Noneの場合は上限なし）
+        deadline: 一括生成全体の締め切り（任意、timeoutはこの残り時間以内に切り詰める）
+        cancel_event: セットされたら処理を中断するイベント
+        tracker: 所要時間の記録先（ヘッジ判定にも使用）
+        hedge: ヘッジリクエストを有効にするか
+        slots: 上流への同時リクエスト数を制限するセマフォ（任意、ヘッジも1つと数える）
+        on_wait: 待機中にpoll_intervalごとに呼ぶ関数（任意、例外を送出すると中断する）
+        retry_on: 再試行する例外クラスのタプル（レート制限や一時的なサーバーエラーなど）
+        max_retries: 1つの呼び出しあたりの最大再試行回数
+        poll_interval: キャンセル確認の間隔（秒）
+
+    Returns:
+        最初に完了した呼び出しの結果
+
+    Raises:
+        TimeoutError: タイムアウトした場合
+        CancelledError: cancel_eventがセットされた場合
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise CancelledError()
+
+    def timeout_error():
+        if deadline is not None and deadline.expired():
+            return TimeoutError("一括生成のタイムアウトに達しました")
+        return TimeoutError(f"{timeout:g}秒以内に完了しませんでした")
+
+    if timeout is not None and timeout <= 0:
+        raise timeout_error()
+    limit = deadline.clamp(timeout) if deadline is not None else timeout
+    if limit is not None and limit <= 0:
+        raise timeout_error()
+    call_deadline = Deadline(limit)
+
+    started_at = {}
+    abandoned = threading.Event()
+
+    def submit():
+        # 破棄した呼び出しが終了を妨げないよう、デーモンスレッドで実行する
+        # （上流側は渡したタイムアウトで打ち切られる）
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def run():
+            if slots is not None:
+                # 空きを待つ間に破棄された場合は上流へ送らない
+                while not slots.acquire(timeout=poll_interval):
+                    if abandoned.is_set():
+                        future.set_exception(CancelledError())
+                        return
+            try:
+                retries = 0
+                while True:
+                    if abandoned.is_set():
+                        raise CancelledError()
+                    remaining = call_deadline.clamp(None)
+                    if remaining is not None and remaining <= 0:
+                        raise timeout_error()
+                    started_at.setdefault(future, time.monotonic())
+                    try:
+                        result = fn(remaining)
+                        break
+                    except retry_on:
+                        # 待ち時間を含めて残り時間内に収まらない場合は再試行しない
+                        delay = RETRY_BACKOFF * 2 ** retries
+                        remaining = call_deadline.clamp(None)
+                        if retries >= max_retries or (remaining is not None and remaining <= delay):
+                            raise
+                        retries += 1
+                        abandoned.wait(delay)
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                if slots is not None:
+                    slots.release()
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    try:
+        pending = {submit()}
+        hedge_delay = tracker.p95() if (hedge and tracker is not None) else None
+        hedge_at = time.monotonic() + hedge_delay if hedge_delay is not None else None
+
+        while True:
+            now = time.monotonic()
+            wait_timeout = poll_interval
+            if call_deadline.remaining() is not None:
+                wait_timeout = min(wait_timeout, call_deadline.remaining())
+            if hedge_at is not None:
+                wait_timeout = min(wait_timeout, max(0.0, hedge_at - now))
+
+            done, pending = wait(pending, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+
+            # 失敗と成功が同時に終わった場合も成功を優先する
+            for future in done:
+                if future.exception() is None:
+                    if tracker is not None:
+                        tracker.record(time.monotonic() - started_at[future])
+                    return future.result()
+            # 失敗した呼び出しは、残りの呼び出しがすべて終わるまで採用しない
+            if done and not pending:
+                raise next(iter(done)).exception()
+
+            if cancel_event is not None and cancel_event.is_set():
+                raise CancelledError()
+            if call_deadline.expired():
+                raise timeout_error()
+            if on_wait is not None:
+                on_wait()
+
+            # p95を超えたら重複リクエストを1つだけ送る
+            if hedge_at is not None and time.monotonic() >= hedge_at:
+                pending.add(submit())
+                hedge_at = None
+    finally:
+        # 空き待ちの呼び出しには上流へ送らないよう知らせる
+        abandoned.set()
@@ -34,6 +34,7 @@ sleep 5
 
 # 割り当てられたポート番号を取得
 PORT=$(docker compose port app 8501 2>/dev/null | cut -d: -f2)
+API_PORT=$(docker compose port api 8000 2>/dev/null | cut -d: -f2)
 
 if [ -z "$PORT" ]; then
     echo "⚠️  ポート番号の取得に失敗しました"
@@ -48,6 +49,7 @@ echo "========================================="
 echo "🎨 Webアプリが利用可能です"
 echo "========================================="
 echo "URL: http://localhost:${PORT}"
+echo "API: http://localhost:${API_PORT}"
 echo ""
 echo "ブラウザを自動的に開きます..."
 echo ""
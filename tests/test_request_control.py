@@ -0,0 +1,240 @@
+"""
+request_control.call_with_deadline のテスト
+上流の代わりに偽の関数fnを渡し、期限・キャンセル・ヘッジ・同時実行枠・再試行の挙動を確認する
+"""
+
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+import request_control
+from request_control import Deadline, LatencyTracker, call_with_deadline
+
+
+POLL_INTERVAL = 0.02
+
+
+def make_tracker(seconds: float) -> LatencyTracker:
+    """p95がsecondsになるよう記録済みのトラッカーを作る"""
+    tracker = LatencyTracker()
+    for _ in range(tracker.min_samples):
+        tracker.record(seconds)
+    return tracker
+
+
+class CountingFn:
+    """呼び出し回数を数え、n回目（0から）の呼び出しをbehaviors[n]で処理する偽のfn"""
+
+    def __init__(self, *behaviors):
+        self.behaviors = behaviors
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, remaining):
+        with self._lock:
+            index = self.calls
+            self.calls += 1
+        return self.behaviors[min(index, len(self.behaviors) - 1)](remaining)
+
+
+def test_zero_timeout_raises_without_calling():
+    fn = CountingFn(lambda remaining: "ok")
+
+    with pytest.raises(TimeoutError):
+        call_with_deadline(fn, timeout=0)
+
+    assert fn.calls == 0
+
+
+def test_expired_deadline_raises_without_calling():
+    fn = CountingFn(lambda remaining: "ok")
+
+    with pytest.raises(TimeoutError, match="一括生成のタイムアウト"):
+        call_with_deadline(fn, timeout=10, deadline=Deadline(0))
+
+    assert Deadline(0).expired()
+    assert fn.calls == 0
+
+
+def test_timeout_message_shows_configured_limit():
+    release = threading.Event()
+    fn = CountingFn(lambda remaining: release.wait(5))
+
+    try:
+        with pytest.raises(TimeoutError, match="0.1秒以内"):
+            call_with_deadline(fn, timeout=0.1, poll_interval=POLL_INTERVAL)
+    finally:
+        release.set()
+
+
+def test_remaining_time_is_passed_to_fn():
+    seen = []
+    fn = CountingFn(lambda remaining: seen.append(remaining) or "ok")
+
+    assert call_with_deadline(fn, timeout=5, deadline=Deadline(1)) == "ok"
+    assert 0 < seen[0] <= 1
+
+
+def test_cancel_event_stops_waiting():
+    release = threading.Event()
+    cancel_event = threading.Event()
+    fn = CountingFn(lambda remaining: release.wait(5))
+    threading.Timer(0.05, cancel_event.set).start()
+
+    try:
+        with pytest.raises(CancelledError):
+            call_with_deadline(
+                fn, timeout=5, cancel_event=cancel_event, poll_interval=POLL_INTERVAL
+            )
+    finally:
+        release.set()
+
+
+def test_hedge_fires_after_p95():
+    release = threading.Event()
+    fn = CountingFn(
+        lambda remaining: release.wait(5) and "original",
+        lambda remaining: "hedge",
+    )
+
+    started = time.monotonic()
+    try:
+        result = call_with_deadline(
+            fn, timeout=5, tracker=make_tracker(0.05), hedge=True, poll_interval=POLL_INTERVAL
+        )
+    finally:
+        release.set()
+
+    assert result == "hedge"
+    assert fn.calls == 2
+    assert time.monotonic() - started < 1
+
+
+def test_no_hedge_without_enough_samples():
+    fn = CountingFn(lambda remaining: time.sleep(0.1) or "original")
+
+    result = call_with_deadline(
+        fn, timeout=5, tracker=LatencyTracker(), hedge=True, poll_interval=POLL_INTERVAL
+    )
+
+    assert result == "original"
+    assert fn.calls == 1
+
+
+def test_failed_attempt_never_wins():
+    # 元の呼び出しの失敗とヘッジの成功を同じwait()で観測させる
+    release = threading.Event()
+
+    def original(remaining):
+        release.wait(5)
+        raise RuntimeError("original failed")
+
+    def hedge(remaining):
+        release.wait(5)
+        return "hedge"
+
+    fn = CountingFn(original, hedge)
+
+    def on_wait():
+        if fn.calls == 2 and not release.is_set():
+            release.set()
+            time.sleep(0.1)
+
+    tracker = make_tracker(0.01)
+    result = call_with_deadline(
+        fn, timeout=5, tracker=tracker, hedge=True, on_wait=on_wait, poll_interval=POLL_INTERVAL
+    )
+
+    assert result == "hedge"
+
+
+def test_failure_raised_when_every_attempt_fails():
+    def fail(remaining):
+        raise RuntimeError("failed")
+
+    tracker = LatencyTracker()
+    with pytest.raises(RuntimeError):
+        call_with_deadline(CountingFn(fail), timeout=5, tracker=tracker)
+
+    # 失敗は所要時間として記録しない
+    assert tracker.p95() is None
+
+
+def test_waiting_attempt_is_not_sent_once_abandoned():
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    fn = CountingFn(lambda remaining: "ok")
+
+    with pytest.raises(TimeoutError):
+        call_with_deadline(fn, timeout=0.1, slots=slots, poll_interval=POLL_INTERVAL)
+
+    slots.release()
+    time.sleep(POLL_INTERVAL * 5)
+    assert fn.calls == 0
+    # 空き待ちをやめた呼び出しは枠を持ち去らない
+    assert slots.acquire(blocking=False)
+
+
+def test_slot_is_released_after_abandoned_attempt_finishes():
+    slots = threading.BoundedSemaphore(1)
+    release = threading.Event()
+    fn = CountingFn(lambda remaining: release.wait(5))
+
+    with pytest.raises(TimeoutError):
+        call_with_deadline(fn, timeout=0.1, slots=slots, poll_interval=POLL_INTERVAL)
+
+    # 破棄した呼び出しは終了するまで枠を占有する
+    assert not slots.acquire(blocking=False)
+    release.set()
+    assert slots.acquire(timeout=1)
+
+
+def test_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr(request_control, "RETRY_BACKOFF", 0.01)
+
+    def fail(remaining):
+        raise ConnectionError("reset")
+
+    fn = CountingFn(fail, fail, lambda remaining: "ok")
+
+    assert call_with_deadline(fn, timeout=5, retry_on=(ConnectionError,)) == "ok"
+    assert fn.calls == 3
+
+
+def test_retries_stop_at_max_retries(monkeypatch):
+    monkeypatch.setattr(request_control, "RETRY_BACKOFF", 0.01)
+
+    def fail(remaining):
+        raise ConnectionError("reset")
+
+    fn = CountingFn(fail)
+
+    with pytest.raises(ConnectionError):
+        call_with_deadline(fn, timeout=5, retry_on=(ConnectionError,), max_retries=1)
+    assert fn.calls == 2
+
+
+def test_does_not_retry_past_the_deadline(monkeypatch):
+    monkeypatch.setattr(request_control, "RETRY_BACKOFF", 1.0)
+
+    def fail(remaining):
+        raise ConnectionError("reset")
+
+    fn = CountingFn(fail)
+
+    with pytest.raises(ConnectionError):
+        call_with_deadline(fn, timeout=0.5, retry_on=(ConnectionError,))
+    assert fn.calls == 1
+
+
+def test_other_errors_are_not_retried():
+    def fail(remaining):
+        raise ValueError("bad request")
+
+    fn = CountingFn(fail)
+
+    with pytest.raises(ValueError):
+        call_with_deadline(fn, timeout=5, retry_on=(ConnectionError,))
+    assert fn.calls == 1
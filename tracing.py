@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+フェーズごとの所要時間を記録するトレーサー
+Chrome trace-event形式（chrome://tracing, Perfetto）で書き出し可能
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+    フェーズ（スパン）ごとの開始時刻と所要時間を記録する（スレッドセーフ）
+
+    Args:
+        enabled: Falseの場合は何も記録しない
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.events = []
+        self._thread_names = {}
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """
+        with文の範囲を1つのスパンとして記録する
+
+        Args:
+            name: フェーズ名
+            **args: トレースに付加する情報（パターン番号など）
+        """
+        if not self.enabled:
+            yield
+            return
+
+        thread = threading.current_thread()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name,
+                "ph": "X",
+                "ts": (start - self._origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": thread.native_id,
+            }
+            if args:
+                event["args"] = args
+            with self._lock:
+                self.events.append(event)
+                self._thread_names[thread.native_id] = thread.name
+
+    def save(self, trace_file: str):
+        """
+        記録したスパンをChrome trace-event形式のJSONで保存する
+
+        Args:
+            trace_file: 保存先のファイルパス
+        """
+        with self._lock:
+            events = list(self.events)
+            thread_names = dict(self._thread_names)
+
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": thread_name},
+            }
+            for tid, thread_name in thread_names.items()
+        ]
+
+        with open(trace_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {"traceEvents": metadata + events, "displayTimeUnit": "ms"},
+                f,
+                ensure_ascii=False
+            )
+
+    def summary(self) -> list:
+        """
+        フェーズごとの集計を返す（最初に記録された順）
+
+        Returns:
+            (フェーズ名, 回数, 合計秒, 平均秒, 最大秒) のリスト
+        """
+        with self._lock:
+            events = list(self.events)
+
+        durations = {}
+        for event in sorted(events, key=lambda e: e["ts"]):
+            durations.setdefault(event["name"], []).append(event["dur"] / 1e6)
+
+        return [
+            (name, len(values), sum(values), sum(values) / len(values), max(values))
+            for name, values in durations.items()
+        ]
+
+    def print_summary(self):
+        """フェーズごとの集計を表形式で表示する"""
+        rows = self.summary()
+        print("\nフェーズ別の所要時間:")
+        print("=" * 60)
+        # 全角文字は表示幅が2倍になるため、見出しは文字数を詰めて揃える
+        print(f"{'フェーズ':<16}{'回数':>4}{'合計(秒)':>9}{'平均(秒)':>9}{'最大(秒)':>9}")
+        print("-" * 60)
+        for name, count, total, mean, longest in rows:
+            print(f"{name:<20}{count:>6}{total:>12.3f}{mean:>12.3f}{longest:>12.3f}")
+        print("=" * 60)
+
+
+# 計測しない場合に使う無効なトレーサー
+NULL_TRACER = Tracer(enabled=False)